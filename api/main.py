@@ -1,14 +1,18 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
-from typing import Optional, Literal
-from pricing_engine.core import load_tables, quote, recommend_license
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Optional, Literal
+from pricing_engine.core import load_tables, quote, recommend_license, batch_quote
 import os
 
 TABLE_PATH = os.getenv("PRICE_TABLE_PATH", "pricing/price_tables.yaml")
+MAX_BATCH_ITEMS = 100
 tables = load_tables(TABLE_PATH)
 
 
 class QuoteInput(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
     license: Optional[str] = None
     kpis: int = Field(ge=0)
     channels: int = Field(ge=0)
@@ -24,17 +28,22 @@ class QuoteInput(BaseModel):
     monthly_report: bool = False
 
 
-app = FastAPI(title="Pini the Pricer API", version="2.0")
+class BatchInput(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    items: List[QuoteInput] = Field(max_length=MAX_BATCH_ITEMS)
+
+
+app = FastAPI(title="Pini the Pricer API", version="2.0", default_response_class=ORJSONResponse)
 
 
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True, "version": tables.version}
 
 
-@app.post("/quote")
-def quote_endpoint(body: QuoteInput):
-    common_kwargs = dict(
+def _common_kwargs(body: QuoteInput) -> dict:
+    return dict(
         kpis=body.kpis,
         channels=body.channels,
         countries=body.countries,
@@ -46,9 +55,32 @@ def quote_endpoint(body: QuoteInput):
         monthly_report=body.monthly_report,
     )
 
+
+def _check_license(body: QuoteInput) -> None:
+    if body.license and body.license not in tables.licenses:
+        raise HTTPException(400, f"Unknown license {body.license}")
+
+
+# Per-unit progressive_breakdown trails are only built with ?verbose=1;
+# otherwise they are returned empty. Pricing can be CPU-heavy (large verbose
+# trails, batches), so these handlers stay sync and run in the threadpool
+# instead of blocking the event loop.
+@app.post("/quote")
+def quote_endpoint(body: QuoteInput, verbose: bool = False):
+    _check_license(body)
+    common_kwargs = _common_kwargs(body)
+
     if body.license:
-        if body.license not in tables.licenses:
-            raise HTTPException(400, f"Unknown license {body.license}")
-        return quote(tables, body.license, **common_kwargs)
+        return quote(tables, body.license, include_trail=verbose, **common_kwargs)
 
-    return recommend_license(tables, **common_kwargs)
+    return recommend_license(tables, include_trail=verbose, **common_kwargs)
+
+
+@app.post("/quotes:batch")
+def batch_endpoint(body: BatchInput, verbose: bool = False):
+    for item in body.items:
+        _check_license(item)
+    return batch_quote(
+        tables,
+        [dict(_common_kwargs(item), license=item.license, include_trail=verbose) for item in body.items],
+    )
@@ -1,9 +1,26 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
-from typing import Dict, List, Tuple, Optional
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, List, Tuple, Optional, Union
+import os
+import pickle
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml-backed
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+
 FeatureKey = str  # 'kpis','channels','countries','users'
+TierLadder = Tuple[List[int], List[float]]  # (ascending thresholds, discount at each threshold)
+
+# The fixed add-on features, in quote() argument order. Per-license feature
+# data is stored in tuples indexed by position in this tuple.
+FEATURE_KEYS: Tuple[FeatureKey, ...] = ("kpis", "channels", "countries", "users")
+
+# Bump whenever the shape of PriceTables changes so stale pickles are ignored.
+_TABLES_CACHE_FORMAT = 7
 
 # Allowed values for the new modifier inputs
 ANALYST_VALUES = {"none", "included"}
@@ -11,15 +28,19 @@ REFRESH_VALUES = {"weekly", "biweekly", "daily"}
 GRANULARITY_VALUES = {"channel", "channel_and_campaign", "campaign"}
 SALES_CHANNELS_VALUES = {1, 2, 3, 4}
 
+# Money is carried as integer cents and ratios (discounts, multipliers) as
+# integer parts-per-million; dollars only appear in the response dicts.
+_PPM = 1_000_000
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class LicenseDef:
-    base_fee: float
+    base_fee_cents: int
     included: Dict[FeatureKey, int]
-    unit_prices: Dict[FeatureKey, float]
+    unit_prices_cents: Dict[FeatureKey, int]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Modifiers:
     """
     Multipliers (as percentage adjustments) and flat fees that apply on top of
@@ -31,31 +52,116 @@ class Modifiers:
     refresh: Dict[str, float]
     granularity: Dict[str, float]
     sales_channels: Dict[int, float]
-    monthly_report_fee: float
+    monthly_report_fee_cents: int
+
+
+@dataclass(slots=True, frozen=True)
+class AddonCurve:
+    """
+    Cumulative add-on pricing for one license/feature, precomputed at load.
+
+    Segment i covers units starts[i] .. starts[i+1]-1, each priced at
+    unit_prices_cents[i]; cumulative_cents[i] is the cost of units
+    1 .. starts[i]-1.
+    """
+    starts: List[int]
+    unit_prices_cents: List[int]
+    cumulative_cents: List[int]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
+class FeaturePricing:
+    """What quote() needs for one license/feature pair."""
+    included: int
+    unit_price_cents: int
+    curve: AddonCurve
+
+
+@dataclass(slots=True, frozen=True)
 class PriceTables:
     version: str
     licenses: Dict[str, LicenseDef]
-    tiers: Dict[FeatureKey, List[Tuple[int, float]]]
+    tiers: Dict[FeatureKey, TierLadder]
     license_discounts: Dict[str, float]
     modifiers: Modifiers
+    # Integer license ids: license_names[i] <-> license_index[name] == i.
+    license_names: List[str]
+    license_index: Dict[str, int]
+    license_defs: List[LicenseDef]
+    # feature_pricing[license_id][feature_idx], feature_idx into FEATURE_KEYS.
+    feature_pricing: List[Tuple[FeaturePricing, ...]]
 
 
 def load_tables(path: str) -> PriceTables:
+    """
+    Load price tables, memoized per (path, mtime_ns, size).
+
+    A pickled copy is kept next to the YAML file (``<path>.pkl``) so new
+    worker processes skip YAML parsing until the YAML file changes again.
+    The pickle records the YAML's mtime_ns and size and is only used when
+    both still match, so a YAML swapped in with an older mtime (cp -p,
+    rsync -a, image layers) is never priced from a stale pickle.
+    """
+    st = os.stat(path)
+    return _load_tables_cached(path, st.st_mtime_ns, st.st_size)
+
+
+@lru_cache(maxsize=8)
+def _load_tables_cached(path: str, mtime_ns: int, size: int) -> PriceTables:
+    cache_path = path + ".pkl"
+    tables = _read_pickle_cache(cache_path, mtime_ns, size)
+    if tables is None:
+        tables = _parse_tables(path)
+        _write_pickle_cache(cache_path, mtime_ns, size, tables)
+    return tables
+
+
+def _read_pickle_cache(cache_path: str, mtime_ns: int, size: int) -> Optional[PriceTables]:
+    # Best-effort: any failure to read or unpickle (including a class path
+    # that no longer imports) just means a fresh YAML parse.
+    try:
+        with open(cache_path, "rb") as f:
+            fmt, src_mtime_ns, src_size, tables = pickle.load(f)
+    except Exception:
+        return None
+    if fmt != _TABLES_CACHE_FORMAT or (src_mtime_ns, src_size) != (mtime_ns, size):
+        return None
+    if not isinstance(tables, PriceTables):
+        return None
+    return tables
+
+
+def _write_pickle_cache(cache_path: str, mtime_ns: int, size: int, tables: PriceTables) -> None:
+    # Write to a per-process temp file, then rename, so concurrent workers
+    # never observe a half-written pickle. The cache is best-effort only.
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump((_TABLES_CACHE_FORMAT, mtime_ns, size, tables), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _parse_tables(path: str) -> PriceTables:
     with open(path, "r") as f:
-        raw = yaml.safe_load(f)
+        raw = yaml.load(f, Loader=SafeLoader)
 
     licenses = {}
     for name, rec in raw["licenses"].items():
         licenses[name] = LicenseDef(
-            base_fee=float(rec.get("base_fee", 0.0)),
+            base_fee_cents=_to_cents(rec.get("base_fee", 0.0)),
             included={k: int(v) for k, v in rec.get("included", {}).items()},
-            unit_prices={k: float(v) for k, v in rec.get("unit_prices", {}).items()},
+            unit_prices_cents={k: _to_cents(v) for k, v in rec.get("unit_prices", {}).items()},
         )
 
-    tiers = {k: [(int(q), float(d)) for q, d in v] for k, v in raw["tiers"].items()}
+    tiers = {}
+    for k, v in raw["tiers"].items():
+        pairs = sorted(((int(q), float(d)) for q, d in v), key=lambda p: p[0])
+        tiers[k] = ([q for q, _ in pairs], [d for _, d in pairs])
     license_discounts = {k: float(v) for k, v in raw.get("license_discounts", {}).items()}
 
     mod_raw = raw.get("modifiers", {}) or {}
@@ -64,45 +170,131 @@ def load_tables(path: str) -> PriceTables:
         refresh={k: float(v) for k, v in (mod_raw.get("refresh") or {}).items()},
         granularity={k: float(v) for k, v in (mod_raw.get("granularity") or {}).items()},
         sales_channels={int(k): float(v) for k, v in (mod_raw.get("sales_channels") or {}).items()},
-        monthly_report_fee=float(mod_raw.get("monthly_report_fee", 0.0)),
+        monthly_report_fee_cents=_to_cents(mod_raw.get("monthly_report_fee", 0.0)),
     )
 
+    license_names = list(licenses)
+    license_defs = [licenses[name] for name in license_names]
+    feature_pricing = []
+    for lic in license_defs:
+        row = []
+        for key in FEATURE_KEYS:
+            unit_cents = lic.unit_prices_cents.get(key, 0)
+            row.append(FeaturePricing(
+                included=lic.included.get(key, 0),
+                unit_price_cents=unit_cents,
+                curve=build_addon_curve(unit_cents, *tiers[key]),
+            ))
+        feature_pricing.append(tuple(row))
+
     return PriceTables(
         version=str(raw.get("version", "v0")),
         licenses=licenses,
         tiers=tiers,
         license_discounts=license_discounts,
         modifiers=modifiers,
+        license_names=license_names,
+        license_index={name: i for i, name in enumerate(license_names)},
+        license_defs=license_defs,
+        feature_pricing=feature_pricing,
     )
 
 
-def discount_for(count: int, ladder: List[Tuple[int, float]]) -> float:
-    d = 0.0
-    for q, disc in ladder:
-        if count >= q:
-            d = disc
-        else:
-            break
-    return d
+def _to_cents(amount) -> int:
+    return int(round(float(amount) * 100))
+
+
+def _to_ppm(ratio: float) -> int:
+    return int(round(ratio * _PPM))
+
+
+def _dollars(cents: int) -> float:
+    return cents / 100
+
+
+def _scale_cents(cents: int, ratio_ppm: int) -> int:
+    """cents * ratio in integer arithmetic, rounded half away from zero."""
+    n = cents * ratio_ppm
+    q = (abs(n) + _PPM // 2) // _PPM
+    return q if n >= 0 else -q
+
+
+def discount_for(count: int, qs: List[int], ds: List[float]) -> float:
+    """Discount of the highest tier whose threshold is <= count (0.0 below the first tier)."""
+    idx = bisect_right(qs, count) - 1
+    return ds[idx] if idx >= 0 else 0.0
+
+
+def _discounted_cents(unit_cents: int, disc: float) -> int:
+    return _scale_cents(unit_cents, _PPM - _to_ppm(disc))
+
+
+def build_addon_curve(unit_cents: int, qs: List[int], ds: List[float]) -> AddonCurve:
+    """
+    Collapse a tier ladder into an AddonCurve for one unit price (in cents).
+    Units below the first tier threshold are undiscounted.
+    """
+    starts = [1]
+    prices = [unit_cents]
+    cumulative = [0]
+    for q, disc in zip(qs, ds):
+        q = max(q, 1)
+        price_n = _discounted_cents(unit_cents, disc)
+        if q == starts[-1]:
+            prices[-1] = price_n
+            continue
+        cumulative.append(cumulative[-1] + (q - starts[-1]) * prices[-1])
+        starts.append(q)
+        prices.append(price_n)
+    return AddonCurve(starts=starts, unit_prices_cents=prices, cumulative_cents=cumulative)
+
+
+def _curve_cost_through(curve: AddonCurve, n: int) -> int:
+    if n < 1:
+        return 0
+    i = bisect_right(curve.starts, n) - 1
+    return curve.cumulative_cents[i] + (n - curve.starts[i] + 1) * curve.unit_prices_cents[i]
+
+
+def addon_curve_unit_price(curve: AddonCurve, n: int) -> int:
+    """Discounted price in cents of unit number n (n >= 1)."""
+    return curve.unit_prices_cents[bisect_right(curve.starts, n) - 1]
+
+
+def addon_curve_total(curve: AddonCurve, included: int, requested: int) -> int:
+    """Add-on total in cents for units included+1 .. requested, in O(log tiers)."""
+    if requested <= included:
+        return 0
+    return _curve_cost_through(curve, requested) - _curve_cost_through(curve, included)
 
 
-def progressive_addon_total(unit_price: float, included: int, requested: int, ladder: List[Tuple[int, float]]):
-    extras = max(0, requested - included)
-    if extras == 0:
-        return 0.0, []
-    total = 0.0
+def progressive_addon_trail(unit_cents: int, included: int, requested: int, qs: List[int], ds: List[float]) -> List[dict]:
+    """
+    Per-unit breakdown for display (prices in dollars). Only build this when
+    it is returned to a caller.
+
+    The tier for the first unit is found by bisection; after that units are
+    visited in order, so the tier pointer only moves forward.
+    """
     trail = []
+    if requested <= included:
+        return trail
+    unit_price = _dollars(unit_cents)
+    tier = bisect_right(qs, included + 1) - 1
+    disc = ds[tier] if tier >= 0 else 0.0
+    price_n = _dollars(_discounted_cents(unit_cents, disc))
     for n in range(included + 1, requested + 1):
-        disc = discount_for(n, ladder)
-        price_n = round(unit_price * (1.0 - disc), 2)
-        total += price_n
+        while tier + 1 < len(qs) and qs[tier + 1] <= n:
+            tier += 1
+            disc = ds[tier]
+            price_n = _dollars(_discounted_cents(unit_cents, disc))
         trail.append({
             "unit_number": n,
             "discount": disc,
             "unit_price": unit_price,
             "price_after_discount": price_n,
         })
-    return round(total, 2), trail
+    return trail
 
 
 def _validate_modifier_choices(
@@ -145,20 +337,20 @@ def compute_modifier_adjustments(
     ]
     additive_total_pct = round(sum(item["pct"] for item in breakdown), 4)
     multiplier = round(1.0 + additive_total_pct / 100.0, 6)
-    monthly_report_fee = float(mods.monthly_report_fee) if monthly_report else 0.0
+    monthly_report_fee_cents = mods.monthly_report_fee_cents if monthly_report else 0
 
     return {
         "breakdown": breakdown,
         "additive_total_pct": additive_total_pct,
         "multiplier": multiplier,
         "monthly_report_enabled": bool(monthly_report),
-        "monthly_report_fee": round(monthly_report_fee, 2),
+        "monthly_report_fee": _dollars(monthly_report_fee_cents),
     }
 
 
 def quote(
     tables: PriceTables,
-    license_name: str,
+    license_name: Union[str, int],
     kpis: int,
     channels: int,
     countries: int,
@@ -168,17 +360,52 @@ def quote(
     granularity: str = "channel",
     sales_channels: int = 2,
     monthly_report: bool = False,
+    include_trail: bool = True,
+) -> dict:
+    """
+    Price one license, given by name or by id from tables.license_index.
+    """
+    return _compute_quote(
+        tables, _license_id(tables, license_name), kpis, channels, countries, users,
+        analyst, refresh, granularity, sales_channels, bool(monthly_report), include_trail,
+    )
+
+
+def _license_id(tables: PriceTables, license_name: Union[str, int]) -> int:
+    if (
+        isinstance(license_name, int)
+        and not isinstance(license_name, bool)
+        and 0 <= license_name < len(tables.license_names)
+    ):
+        return license_name
+    if isinstance(license_name, str) and license_name in tables.license_index:
+        return tables.license_index[license_name]
+    raise ValueError(f"Unknown license: {license_name}")
+
+
+def _compute_quote(
+    tables: PriceTables,
+    license_id: int,
+    kpis: int,
+    channels: int,
+    countries: int,
+    users: int,
+    analyst: str,
+    refresh: str,
+    granularity: str,
+    sales_channels: int,
+    monthly_report: bool,
+    include_trail: bool,
 ) -> dict:
-    if license_name not in tables.licenses:
-        raise ValueError(f"Unknown license: {license_name}")
     _validate_modifier_choices(analyst, refresh, granularity, sales_channels)
 
-    lic = tables.licenses[license_name]
+    license_name = tables.license_names[license_id]
+    lic = tables.license_defs[license_id]
     out = {
         "license": license_name,
         "version": tables.version,
         "items": [],
-        "base_fee": round(lic.base_fee, 2),
+        "base_fee": _dollars(lic.base_fee_cents),
         "inputs": {
             "kpis": kpis,
             "channels": channels,
@@ -192,54 +419,66 @@ def quote(
         },
     }
 
-    # 1) Base + volume add-ons (unchanged from prior versions)
-    subtotal = lic.base_fee
-    for key, req in [("kpis", kpis), ("channels", channels), ("countries", countries), ("users", users)]:
-        unit = float(lic.unit_prices.get(key, 0.0))
-        inc = int(lic.included.get(key, 0))
-        total, trail = progressive_addon_total(unit, inc, req, tables.tiers[key])
-        out["items"].append({
-            "key": key,
-            "requested": req,
-            "included": inc,
-            "unit_price": unit,
-            "progressive_breakdown": trail,
-            "line_total": total,
-        })
-        subtotal += total
+    # 1) Base + volume add-ons (unchanged from prior versions). The feature
+    # set is fixed, so the four lines are priced straight through.
+    kpis_fp, channels_fp, countries_fp, users_fp = tables.feature_pricing[license_id]
+    kpis_item, kpis_total = _line_item(tables, kpis_fp, "kpis", kpis, include_trail)
+    channels_item, channels_total = _line_item(tables, channels_fp, "channels", channels, include_trail)
+    countries_item, countries_total = _line_item(tables, countries_fp, "countries", countries, include_trail)
+    users_item, users_total = _line_item(tables, users_fp, "users", users, include_trail)
+
+    out["items"] = [kpis_item, channels_item, countries_item, users_item]
+    subtotal = lic.base_fee_cents + kpis_total + channels_total + countries_total + users_total
 
-    out["subtotal_before_modifiers"] = round(subtotal, 2)
+    out["subtotal_before_modifiers"] = _dollars(subtotal)
 
     # 2) Apply additive modifier stack to subtotal
     mod_info = compute_modifier_adjustments(
         tables, analyst, refresh, granularity, sales_channels, monthly_report
     )
-    multiplier = mod_info["multiplier"]
-    subtotal_after_modifiers = round(subtotal * multiplier, 2)
-    modifier_delta = round(subtotal_after_modifiers - subtotal, 2)
+    subtotal_after_modifiers = _scale_cents(subtotal, _to_ppm(mod_info["multiplier"]))
+    modifier_delta = subtotal_after_modifiers - subtotal
 
     out["modifiers"] = mod_info
-    out["modifier_adjustment_amount"] = modifier_delta
-    out["subtotal_after_modifiers"] = subtotal_after_modifiers
+    out["modifier_adjustment_amount"] = _dollars(modifier_delta)
+    out["subtotal_after_modifiers"] = _dollars(subtotal_after_modifiers)
 
     # 3) Apply license-level discount on the modifier-adjusted subtotal
     lic_disc = float(tables.license_discounts.get(license_name, 0.0))
-    discount_amount = round(subtotal_after_modifiers * lic_disc, 2)
-    after_discount = round(subtotal_after_modifiers - discount_amount, 2)
+    discount_amount = _scale_cents(subtotal_after_modifiers, _to_ppm(lic_disc))
+    after_discount = subtotal_after_modifiers - discount_amount
 
-    out["subtotal_before_license_discount"] = subtotal_after_modifiers
+    out["subtotal_before_license_discount"] = _dollars(subtotal_after_modifiers)
     out["license_discount_pct"] = lic_disc
-    out["license_discount_amount"] = discount_amount
+    out["license_discount_amount"] = _dollars(discount_amount)
 
     # 4) Add flat monthly report fee on top of everything
-    monthly_report_fee = mod_info["monthly_report_fee"]
-    total_monthly = round(after_discount + monthly_report_fee, 2)
+    monthly_report_fee = tables.modifiers.monthly_report_fee_cents if monthly_report else 0
+    total_monthly = after_discount + monthly_report_fee
 
-    out["total_monthly"] = total_monthly
-    out["total_annual"] = round(total_monthly * 12, 2)
+    out["total_monthly"] = _dollars(total_monthly)
+    out["total_annual"] = _dollars(total_monthly * 12)
     return out
 
 
+def _line_item(tables: PriceTables, fp: FeaturePricing, key: FeatureKey, req: int, include_trail: bool) -> Tuple[dict, int]:
+    """One add-on line for quote(), plus its total in cents."""
+    unit, inc, curve = fp.unit_price_cents, fp.included, fp.curve
+    total = addon_curve_total(curve, inc, req)
+    trail = progressive_addon_trail(unit, inc, req, *tables.tiers[key]) if include_trail else []
+    item = {
+        "key": key,
+        "requested": req,
+        "included": inc,
+        "unit_price": _dollars(unit),
+        # Price of the last requested add-on unit; available without the trail.
+        "last_unit_price": _dollars(addon_curve_unit_price(curve, req)) if req > inc else None,
+        "progressive_breakdown": trail,
+        "line_total": _dollars(total),
+    }
+    return item, total
+
+
 def recommend_license(
     tables: PriceTables,
     kpis: int,
@@ -251,14 +490,38 @@ def recommend_license(
     granularity: str = "channel",
     sales_channels: int = 2,
     monthly_report: bool = False,
+    include_trail: bool = True,
 ) -> dict:
-    quotes = {}
-    for lic in tables.licenses.keys():
-        q = quote(
-            tables, lic, kpis, channels, countries, users,
-            analyst=analyst, refresh=refresh, granularity=granularity,
-            sales_channels=sales_channels, monthly_report=monthly_report,
-        )
-        quotes[lic] = q
-    best = min(quotes.values(), key=lambda q: q["total_monthly"])
-    return {"recommended": best["license"], "quotes": quotes}
+    common_kwargs = dict(
+        kpis=kpis, channels=channels, countries=countries, users=users,
+        analyst=analyst, refresh=refresh, granularity=granularity,
+        sales_channels=sales_channels, monthly_report=monthly_report,
+    )
+    # Compare licenses without per-unit trails; only the winner gets one.
+    results = batch_quote(
+        tables, [dict(common_kwargs, license=lic, include_trail=False) for lic in tables.license_names]
+    )
+    quotes = {q["license"]: q for q in results}
+    best = min(results, key=lambda q: q["total_monthly"])["license"]
+    if include_trail:
+        quotes[best] = quote(tables, best, **common_kwargs)
+    return {"recommended": best, "quotes": quotes}
+
+
+def batch_quote(tables: PriceTables, requests: List[dict]) -> List[dict]:
+    """
+    Price several requests in one call, preserving order.
+
+    Each request holds quote() keyword arguments plus an optional
+    "license" (name or id). Requests without a license (None or "") get
+    recommend_license() output, the same as the single /quote endpoint.
+    """
+    results = []
+    for req in requests:
+        kwargs = dict(req)
+        license_name = kwargs.pop("license", None)
+        if license_name is not None and license_name != "":
+            results.append(quote(tables, license_name, **kwargs))
+        else:
+            results.append(recommend_license(tables, **kwargs))
+    return results
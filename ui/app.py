@@ -1,6 +1,22 @@
+import base64
+import hmac
+import html
+import json
+import operator
 import os
+import sys
+import time
+from functools import lru_cache
+import pandas as pd
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib json fallback
+    orjson = None
 
 
 # ----------------------------
@@ -9,34 +25,69 @@ import streamlit as st
 PRICER_API_URL = os.getenv("PRICER_API_URL", "http://localhost:8000").rstrip("/")
 APP_TITLE = "Pini the Pricer"
 
+OPENAI_MODEL = "gpt-4o-mini"
+SALES_SYSTEM_PROMPT = "You are a crisp, helpful pricing sales assistant. Keep it short and practical."
+_SALES_SYSTEM_MESSAGES = ({"role": "system", "content": SALES_SYSTEM_PROMPT},)
+
+QUOTE_CACHE_TTL_S = 300
+RETRY_AFTER_CAP_S = 5
+
 IMAGE_URL = "https://incrmntal-website.s3.amazonaws.com/Pinilogo_efa5df4e90.png?updated_at=2025-09-09T08:07:49.998Z"
 
 
 # ----------------------------
 # Header
 # ----------------------------
-def render_header():
-    user = st.session_state.get("user", {})
+_API_CAPTION = f"API: {PRICER_API_URL}"
 
-    st.markdown(
-        f"""
+_HEADER_TEMPLATE = f"""
 <div style="display:flex; align-items:center; justify-content:space-between; padding:4px 0 8px 0;">
   <div style="display:flex; align-items:center; gap:12px;">
     <h1 style="margin:0;">{APP_TITLE}</h1>
-    <div style="font-size:0.9rem; opacity:0.8;">{user.get('email','')}</div>
+    <div style="font-size:0.9rem; opacity:0.8;">{{email}}</div>
   </div>
-  <img src="{IMAGE_URL}" alt="INCRMNTAL" style="height:100px; max-height:100px; object-fit:contain;" />
+  <img src="{{logo}}" alt="INCRMNTAL" style="height:100px; max-height:100px; object-fit:contain;" />
 </div>
-""",
+"""
+
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _logo_data_uri() -> str:
+    r = requests.get(IMAGE_URL, timeout=5)
+    r.raise_for_status()
+    return "data:image/png;base64," + base64.b64encode(r.content).decode("ascii")
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _logo_src() -> str:
+    # Inline the logo so browsers skip the S3 fetch. A failed fetch falls back
+    # to the remote URL, and that fallback is cached too so an unreachable S3
+    # costs one timeout per TTL rather than one per rerun.
+    try:
+        return _logo_data_uri()
+    except Exception:
+        return IMAGE_URL
+
+
+def render_header():
+    user = st.session_state.get("user", {})
+
+    st.markdown(
+        _HEADER_TEMPLATE.format(
+            email=html.escape(str(user.get("email", ""))),
+            logo=_logo_src(),
+        ),
         unsafe_allow_html=True,
     )
-    st.caption(f"API: {PRICER_API_URL}")
+    st.caption(_API_CAPTION)
 
 
 # ----------------------------
 # Auth
 # ----------------------------
+@st.cache_resource
 def _get_access_key() -> str:
+    # Env and secrets are fixed for the life of the process; resolve once.
     candidates = [
         os.getenv("PRICER_ACCESS_KEY", ""),
         os.getenv("APP_ACCESS_KEY", ""),
@@ -65,6 +116,10 @@ def _get_access_key() -> str:
 
 
 def require_login():
+    # Signed-in reruns are the common case; return before any key lookup.
+    if st.session_state.get("authed"):
+        return
+
     access_key = _get_access_key()
 
     if not access_key:
@@ -74,10 +129,9 @@ def require_login():
         )
         return
 
-    if st.session_state.get("authed"):
-        return
-
-    render_header()
+    # Lightweight header until signed in; the full one (logo, email) renders after auth.
+    st.title(APP_TITLE)
+    st.caption(_API_CAPTION)
 
     st.subheader("Sign in")
     entered = st.text_input("Access key", type="password")
@@ -85,7 +139,7 @@ def require_login():
     col_a, col_b = st.columns([1, 5])
     with col_a:
         if st.button("Sign in", use_container_width=True):
-            if entered.strip() == access_key:
+            if hmac.compare_digest(entered.strip().encode(), access_key.encode()):
                 st.session_state["authed"] = True
                 st.rerun()
             else:
@@ -97,9 +151,16 @@ def require_login():
 # ----------------------------
 # Helpers
 # ----------------------------
+@lru_cache(maxsize=2048)
+def _money_cached(dollars: int) -> str:
+    return f"${dollars:,}"
+
+
 def money(x: float) -> str:
     try:
-        return f"${float(x):,.0f}"
+        if isinstance(x, (int, float)):
+            return _money_cached(round(x))
+        return _money_cached(round(float(x)))
     except Exception:
         return "$0"
 
@@ -114,13 +175,149 @@ def pct(x: float, decimals: int = 0) -> str:
         return "0%"
 
 
-def call_quote_api(payload: dict) -> dict:
+class _CappedRetry(Retry):
+    # urllib3 sleeps for the full Retry-After; clamp it so a long server hint
+    # can't freeze the script. rate_limit_message() still reports the header.
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, RETRY_AFTER_CAP_S)
+
+
+@st.cache_resource
+def _get_session() -> requests.Session:
+    # One pooled session per process so quote calls reuse keep-alive connections.
+    # Read timeouts are not retried: a stalled API fails after one read timeout
+    # instead of once per attempt. Connect errors and 429/5xx still retry.
+    s = requests.Session()
+    s.headers["User-Agent"] = "pini-the-pricer-ui"
+    retry = _CappedRetry(
+        total=3,
+        read=False,
+        backoff_factor=0.5,
+        backoff_max=16,
+        backoff_jitter=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+@st.cache_data(ttl=QUOTE_CACHE_TTL_S, max_entries=128, show_spinner=False)
+def _call_quote_api_cached(payload_items: tuple) -> dict:
     url = f"{PRICER_API_URL}/quote"
-    r = requests.post(url, json=payload, timeout=30)
+    r = _get_session().post(url, json=dict(payload_items), timeout=(3.05, 15))
     r.raise_for_status()
+    if orjson is not None:
+        return orjson.loads(r.content)
     return r.json()
 
 
+def call_quote_api(payload: dict) -> dict:
+    # Quotes are deterministic per payload; identical submits skip the round trip.
+    return _call_quote_api_cached(tuple(sorted(payload.items())))
+
+
+def _auto_quote_key(payload: dict) -> tuple:
+    return tuple(sorted({**payload, "license": None}.items()))
+
+
+def quote_from_auto_stash(payload: dict):
+    # A forced-license quote is identical to that license's entry in the auto quote
+    # for the same inputs, so serve it from the last auto result when it still applies.
+    # Staleness is bounded by the TTL (same as the API cache); Refresh clears the
+    # stash, and a fresh forced quote on a new table version evicts it.
+    lic = payload.get("license")
+    stash = st.session_state.get("auto_quote")
+    if not lic or not stash or stash["key"] != _auto_quote_key(payload):
+        return None
+    if time.monotonic() - stash["at"] > QUOTE_CACHE_TTL_S:
+        return None
+    return (stash["result"].get("quotes") or {}).get(lic) or None
+
+
+def remember_quote(payload: dict, result: dict):
+    if "recommended" in result and "quotes" in result:
+        versions = {q.get("version") for q in (result.get("quotes") or {}).values()}
+        st.session_state["auto_quote"] = {
+            "key": _auto_quote_key(payload),
+            "version": versions.pop() if len(versions) == 1 else None,
+            "at": time.monotonic(),
+            "result": result,
+        }
+        return
+
+    # A fresh forced quote on a newer price-table version retires the stashed auto quote.
+    stash = st.session_state.get("auto_quote")
+    if stash and result.get("version") != stash["version"]:
+        st.session_state.pop("auto_quote", None)
+
+
+@st.cache_resource
+def _openai_client(api_key: str):
+    # One client (and its httpx pool) per key instead of one per click.
+    from openai import OpenAI
+
+    return OpenAI(api_key=api_key, timeout=30.0, max_retries=2)
+
+
+_UNIT_NUMBER_KEYS = ("unit_number", "unit", "n", "index")
+_PRICE_KEYS = ("price_after_discount", "net_unit_price", "addon_unit_price", "unit_price_after_discount")
+
+
+def _index_pb(pb: list) -> tuple:
+    # One pass over the trail: first row per unit number, plus the last row.
+    by_unit = {}
+    for row in pb:
+        if not isinstance(row, dict):
+            continue
+        unit_n = next((row[k] for k in _UNIT_NUMBER_KEYS if row.get(k)), None)
+        try:
+            by_unit.setdefault(int(unit_n), row)
+        except Exception:
+            pass
+    last_row = pb[-1] if isinstance(pb[-1], dict) else None
+    return by_unit, last_row
+
+
+def _row_price(row) -> float:
+    if not row:
+        return 0.0
+    return next(
+        (float(row[k]) for k in _PRICE_KEYS if isinstance(row.get(k), (int, float)) and float(row[k]) > 0),
+        0.0,
+    )
+
+
+def _is_openai_timeout(e: Exception) -> bool:
+    # openai is imported lazily by _openai_client; only check once it is loaded.
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(e, openai.APITimeoutError)
+
+
+def rate_limit_message(resp: requests.Response) -> str:
+    # The session has already retried (waiting at most RETRY_AFTER_CAP_S per try);
+    # pass the server's full Retry-After on to the user.
+    code = "rate_limited"
+    try:
+        body = resp.json()
+        if isinstance(body, dict) and body.get("code"):
+            code = str(body["code"])
+    except Exception:
+        pass
+
+    retry_after = (resp.headers.get("Retry-After") or "").strip()
+    if retry_after.isdigit():
+        return f"Pricing API is busy ({code}). Retry in {int(retry_after)}s."
+    return f"Pricing API is busy ({code}). Retry in a few seconds."
+
+
 def unit_number_label(item: dict) -> int:
     requested = int(item.get("requested", 0) or 0)
     return max(1, requested)
@@ -130,45 +327,25 @@ def last_unit_cost_display(item: dict) -> float:
     requested = int(item.get("requested", 0) or 0)
     included = int(item.get("included", 0) or 0)
 
-    base_unit = item.get("unit_price")
-    if not isinstance(base_unit, (int, float)):
-        base_unit = 0.0
-    base_unit = float(base_unit)
-
     line_total = item.get("line_total", 0.0)
-    if not isinstance(line_total, (int, float)):
-        line_total = 0.0
+    if requested <= included or not isinstance(line_total, (int, float)) or line_total <= 0:
+        base_unit = item.get("unit_price")
+        return float(base_unit) if isinstance(base_unit, (int, float)) and base_unit > 0 else 0.0
     line_total = float(line_total)
 
-    if requested <= included or line_total <= 0:
-        return base_unit if base_unit > 0 else 0.0
+    last_unit_price = item.get("last_unit_price")
+    if isinstance(last_unit_price, (int, float)) and float(last_unit_price) > 0:
+        return float(last_unit_price)
 
     target_unit = max(1, requested)
     pb = item.get("progressive_breakdown")
 
     if isinstance(pb, list) and pb:
-        for row in pb:
-            if not isinstance(row, dict):
-                continue
-
-            unit_n = row.get("unit_number") or row.get("unit") or row.get("n") or row.get("index")
-            try:
-                unit_n = int(unit_n)
-            except Exception:
-                unit_n = None
-
-            if unit_n == target_unit:
-                for k in ["price_after_discount", "net_unit_price", "addon_unit_price", "unit_price_after_discount"]:
-                    v = row.get(k)
-                    if isinstance(v, (int, float)) and float(v) > 0:
-                        return float(v)
-
-        last_row = pb[-1]
-        if isinstance(last_row, dict):
-            for k in ["price_after_discount", "net_unit_price", "addon_unit_price", "unit_price_after_discount"]:
-                v = last_row.get(k)
-                if isinstance(v, (int, float)) and float(v) > 0:
-                    return float(v)
+        by_unit, last_row = _index_pb(pb)
+        for row in (by_unit.get(target_unit), last_row):
+            v = _row_price(row)
+            if v > 0:
+                return v
 
     addon_units = requested - included
     if addon_units > 0:
@@ -177,6 +354,24 @@ def last_unit_cost_display(item: dict) -> float:
     return 0.0
 
 
+def _json_bytes(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _pretty_json(payload: bytes) -> str:
+    if orjson is not None:
+        return orjson.dumps(orjson.loads(payload), option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(json.loads(payload), indent=2)
+
+
+def render_json(obj):
+    # Pretty-print once per distinct payload instead of st.json re-serializing each rerun.
+    st.code(_pretty_json(_json_bytes(obj)), language="json")
+
+
 def render_unit_costs_block(quote_obj: dict):
     st.subheader("Add On Costs")
     items = quote_obj.get("items", []) or []
@@ -273,35 +468,120 @@ def render_quote_summary(quote_obj: dict):
     st.write(f"### {money(total_annual)}")
 
 
+_LINE_ITEM_FORMATS = {"Unit price": "${:,.0f}", "Add-ons /mo": "${:,.0f}"}
+
+
+def line_items_frame(items: list) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "Item": [str(it.get("key", "")) for it in items],
+            "Requested": [int(it.get("requested", 0) or 0) for it in items],
+            "Included": [int(it.get("included", 0) or 0) for it in items],
+            "Unit price": [float(it.get("unit_price", 0.0) or 0.0) for it in items],
+            "Add-ons /mo": [float(it.get("line_total", 0.0) or 0.0) for it in items],
+        }
+    )
+
+
+def render_line_items_table(items: list):
+    if not items:
+        st.info("No items returned.")
+        return
+
+    st.dataframe(
+        line_items_frame(items).style.format(_LINE_ITEM_FORMATS),
+        use_container_width=True,
+        hide_index=True,
+    )
+
+
+def render_compare_line_items(quotes: dict):
+    frames = []
+    for lic_name, q in quotes.items():
+        df = line_items_frame(q.get("items") or [])
+        df.insert(0, "License", lic_name)
+        frames.append(df)
+
+    if not frames:
+        st.info("No quotes returned.")
+        return
+
+    st.dataframe(
+        pd.concat(frames, ignore_index=True).style.format(_LINE_ITEM_FORMATS),
+        use_container_width=True,
+        hide_index=True,
+    )
+
+
+_get_totals = operator.itemgetter("total_monthly", "total_annual", "license_discount_pct")
+
+
+def _license_totals(q: dict) -> tuple:
+    try:
+        totals = _get_totals(q)
+    except KeyError:
+        totals = (q.get("total_monthly"), q.get("total_annual"), q.get("license_discount_pct"))
+    return tuple(v or 0.0 for v in totals)
+
+
 def render_all_licenses_table(result: dict, recommended: str):
     quotes = result.get("quotes", {}) or {}
     if not quotes:
         return
 
-    rows = []
-    for lic_name, q in quotes.items():
-        rows.append(
-            {
-                "License": lic_name,
-                "Monthly": q.get("total_monthly", 0.0),
-                "Annual": q.get("total_annual", 0.0),
-                "Discount %": q.get("license_discount_pct", 0.0),
-            }
-        )
-
-    rows.sort(key=lambda r: float(r.get("Monthly", 0.0) or 0.0))
+    df = pd.DataFrame(
+        [_license_totals(q) for q in quotes.values()],
+        columns=["Monthly", "Annual", "Discount %"],
+        dtype=float,
+    )
+    df.insert(0, "License", list(quotes))
+    df.sort_values("Monthly", inplace=True, kind="stable")
 
     st.subheader("All licenses")
-    for r in rows:
-        r["Monthly"] = money(r["Monthly"])
-        r["Annual"] = money(r["Annual"])
+    st.dataframe(
+        df.style.format({"Monthly": "${:,.0f}", "Annual": "${:,.0f}", "Discount %": "{:.0%}"}),
+        use_container_width=True,
+        hide_index=True,
+    )
+    st.caption(f"Recommended: {recommended}")
+
+
+@st.fragment
+def render_sales_assistant():
+    # Fragment: typing a prompt or clicking Generate reruns only this tab, not the quote flow.
+    st.subheader("Sales assistant")
+    st.caption("Optional. Requires OPENAI_API_KEY in the environment.")
+
+    prompt = st.text_area(
+        "What do you want to say to the prospect?",
+        value="Write a short explanation of the quote and why this package fits. Keep it crisp.",
+        height=120,
+    )
+
+    if st.button("Generate"):
+        api_key = os.getenv("OPENAI_API_KEY", "").strip()
+        if not api_key:
+            st.error("OPENAI_API_KEY is not set. Add it to your environment and redeploy.")
+            return
+
         try:
-            r["Discount %"] = f"{int(float(r['Discount %']) * 100)}%"
-        except Exception:
-            r["Discount %"] = "0%"
+            client = _openai_client(api_key)
 
-    st.table(rows)
-    st.caption(f"Recommended: {recommended}")
+            stream = client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[*_SALES_SYSTEM_MESSAGES, {"role": "user", "content": prompt}],
+                temperature=0.4,
+                stream=True,
+            )
+            st.write_stream(
+                (chunk.choices[0].delta.content or "") if chunk.choices else ""
+                for chunk in stream
+            )
+        except Exception as e:
+            if _is_openai_timeout(e):
+                st.warning("The assistant took too long to respond. Please try again.")
+            else:
+                st.error(f"OpenAI call failed: {e}")
 
 
 # ----------------------------
@@ -376,9 +656,17 @@ with tab_quote:
         st.write("")
         force_license = st.text_input("Force license (optional)", value="(auto)")
 
-        submitted = st.form_submit_button("Get quote")
+        b1, b2, _ = st.columns([1, 1, 6])
+        with b1:
+            submitted = st.form_submit_button("Get quote")
+        with b2:
+            refreshed = st.form_submit_button("Refresh", help="Bypass cached quotes and re-fetch from the API.")
+
+    if refreshed:
+        _call_quote_api_cached.clear()
+        st.session_state.pop("auto_quote", None)
 
-    if submitted:
+    if submitted or refreshed:
         force_license_clean = force_license.strip()
         if force_license_clean == "(auto)" or force_license_clean == "":
             force_license_clean = None
@@ -397,8 +685,16 @@ with tab_quote:
         }
 
         try:
-            result = call_quote_api(payload)
+            result = quote_from_auto_stash(payload)
+            if result is None:
+                result = call_quote_api(payload)
+                remember_quote(payload, result)
+            st.session_state["quote_result"] = result
         except requests.HTTPError as e:
+            st.session_state.pop("quote_result", None)
+            if e.response is not None and e.response.status_code == 429:
+                st.warning(rate_limit_message(e.response))
+                st.stop()
             st.error(f"API error: {e}")
             try:
                 st.code(e.response.text)
@@ -406,9 +702,13 @@ with tab_quote:
                 pass
             st.stop()
         except Exception as e:
+            st.session_state.pop("quote_result", None)
             st.error(f"Error calling API: {e}")
             st.stop()
 
+    # Kept in session state so the opt-in toggles below survive their own reruns.
+    result = st.session_state.get("quote_result")
+    if result:
         st.divider()
 
         if "recommended" in result and "quotes" in result:
@@ -419,7 +719,7 @@ with tab_quote:
             if not quote_obj:
                 st.error("Recommendation returned, but the recommended quote is missing.")
                 with st.expander("Debug", expanded=False):
-                    st.json(result)
+                    render_json(result)
                 st.stop()
 
             st.divider()
@@ -432,21 +732,12 @@ with tab_quote:
 
             with st.expander("Compare line items by license", expanded=False):
                 quotes = result.get("quotes", {}) or {}
-                for lic_name, q in quotes.items():
-                    st.markdown(f"#### {lic_name} - {money(q.get('total_monthly', 0.0))}/mo")
-                    for item in (q.get("items") or []):
-                        key = item.get("key", "")
-                        req = item.get("requested", 0)
-                        inc = item.get("included", 0)
-                        unit_price = item.get("unit_price", 0.0)
-                        line_total = item.get("line_total", 0.0)
-                        st.write(
-                            f"- {key}: requested {req}, included {inc}, unit {money(unit_price)}, add-ons {money(line_total)}/mo"
-                        )
-                    st.write("")
+                if st.checkbox("Show comparison", key="show_comparison"):
+                    render_compare_line_items(quotes)
 
             with st.expander("Debug: raw payload", expanded=False):
-                st.json(result)
+                if st.checkbox("Load payload", key="show_debug_payload"):
+                    render_json(result)
 
         else:
             quote_obj = result
@@ -460,57 +751,11 @@ with tab_quote:
             render_unit_costs_block(quote_obj)
 
             with st.expander("Line items", expanded=False):
-                for item in (quote_obj.get("items") or []):
-                    key = item.get("key", "")
-                    req = item.get("requested", 0)
-                    inc = item.get("included", 0)
-                    unit_price = item.get("unit_price", 0.0)
-                    line_total = item.get("line_total", 0.0)
-                    trail = item.get("progressive_breakdown", [])
-
-                    st.markdown(f"**{key}**")
-                    st.write(f"Requested: {req} | Included: {inc}")
-                    st.write(f"Unit price: {money(unit_price)}")
-                    st.write(f"Add-ons total: {money(line_total)}/mo")
-
-                    if trail:
-                        st.caption("Progressive breakdown")
-                        st.json(trail)
-                    st.write("")
+                render_line_items_table(quote_obj.get("items") or [])
 
             with st.expander("Debug: raw payload", expanded=False):
-                st.json(quote_obj)
+                if st.checkbox("Load payload", key="show_debug_payload"):
+                    render_json(quote_obj)
 
 with tab_sales:
-    st.subheader("Sales assistant")
-    st.caption("Optional. Requires OPENAI_API_KEY in the environment.")
-
-    prompt = st.text_area(
-        "What do you want to say to the prospect?",
-        value="Write a short explanation of the quote and why this package fits. Keep it crisp.",
-        height=120,
-    )
-
-    if st.button("Generate"):
-        api_key = os.getenv("OPENAI_API_KEY", "").strip()
-        if not api_key:
-            st.error("OPENAI_API_KEY is not set. Add it to your environment and redeploy.")
-            st.stop()
-
-        try:
-            from openai import OpenAI
-
-            client = OpenAI(api_key=api_key)
-
-            resp = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a crisp, helpful pricing sales assistant. Keep it short and practical."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.4,
-            )
-            out = resp.choices[0].message.content
-            st.write(out)
-        except Exception as e:
-            st.error(f"OpenAI call failed: {e}")
+    render_sales_assistant()